@@ -1,16 +1,30 @@
 import os
+import re
+import html
+import hashlib
+import secrets
 import asyncio
-from datetime import datetime
+import logging
+import time
+from contextlib import asynccontextmanager
+from datetime import datetime, timezone
+import asyncpg
+from cachetools import TTLCache
 from aiogram import Bot, Dispatcher, F, types
 from aiogram.client.default import DefaultBotProperties
+from aiogram.client.session.aiohttp import AiohttpSession
 from aiogram.enums import ParseMode
+from aiogram.exceptions import TelegramRetryAfter
+from aiogram.methods import SendMessage, SendPhoto
 from aiogram.types import Message
 from aiogram.filters import CommandStart
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
-from aiogram.fsm.storage.memory import MemoryStorage
-from fastapi import FastAPI, Request
-from supabase import create_client, Client
+from aiogram.fsm.storage.redis import RedisStorage
+import orjson
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.responses import ORJSONResponse
+from redis.asyncio import Redis
 from dotenv import load_dotenv
 
 # =========================
@@ -19,28 +33,78 @@ from dotenv import load_dotenv
 load_dotenv()
 
 TELEGRAM_BOT_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
-SUPABASE_URL = os.getenv("NEXT_PUBLIC_SUPABASE_URL")
-SUPABASE_KEY = os.getenv("NEXT_PUBLIC_SUPABASE_ANON_KEY")
+DATABASE_URL = os.getenv("DATABASE_URL")
+REDIS_URL = os.getenv("REDIS_URL")
+# Публичный URL вебхука и секрет, который Telegram присылает в X-Telegram-Bot-Api-Secret-Token
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")
+# DSN указывает на пулер в transaction mode (Supavisor :6543 / pgbouncer)
+DB_TRANSACTION_POOLER = os.getenv("DB_TRANSACTION_POOLER", "false").lower() == "true"
+INIT_SQL_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "sql", "init.sql")
 
 ALLOWED_ADMIN = "@denisHr55"
-HR_USERS = [
+# Числовой chat id админа для уведомлений: Bot API принимает "@username" только для каналов.
+# Если не задан, берётся id, сохранённый при /start админа.
+ADMIN_CHAT_ID = os.getenv("ADMIN_CHAT_ID")
+# Юзернеймы в Telegram регистронезависимы: храним в нижнем регистре и сравниваем username.lower()
+HR_USERS = frozenset(u.lower() for u in (
     "@mkkdko", "@Annahrg25", "@sun_crazy", "@dooro4ka", "@nuttupp",
     "@luilu_hr", "@Dmytry44gg", "@lilkalinaa_rabotka", "@kirusiyaaa15",
     "@VladHR27", "@sophie_hr", "@DimitryHr", "@karisha522", "@arinaa_hr"
-]
-IT_USERS = ["@denishr55"]
+))
+IT_USERS = frozenset(u.lower() for u in ("@denishr55",))
+# Роль по юзернейму в нижнем регистре (админ определяется отдельно, по ALLOWED_ADMIN)
+USER_ROLES = {u: "hr" for u in HR_USERS} | {u: "it" for u in IT_USERS}
 
-IT_CATEGORIES = ["Работа юа", "Джубл", "Телеграм", "Таргет", "Другое"]
+IT_CATEGORIES = ("Работа юа", "Джубл", "Телеграм", "Таргет", "Другое")
+IT_CATEGORIES_SET = frozenset(IT_CATEGORIES)
+
+UNKNOWN_USER_TEXT = "❌ Вы не зарегистрированы. Нажмите /start и повторите."
+
+logger = logging.getLogger(__name__)
 
 # =========================
 # Инициализация
 # =========================
+# Один keep-alive пул соединений к api.telegram.org на все запросы бота
+session = AiohttpSession(limit=100)
+session._connector_init.update(limit_per_host=30, ttl_dns_cache=300)
 bot = Bot(
     token=TELEGRAM_BOT_TOKEN,
+    session=session,
     default=DefaultBotProperties(parse_mode=ParseMode.HTML)
 )
-dp = Dispatcher(storage=MemoryStorage())
-supabase: Client = create_client(SUPABASE_URL, SUPABASE_KEY)
+# FSM-состояния в Redis: общие для всех воркеров и переживают рестарт.
+# Брошенные диалоги истекают через сутки.
+redis = Redis.from_url(REDIS_URL)
+dp = Dispatcher(storage=RedisStorage(redis=redis, state_ttl=86400, data_ttl=86400))
+pool: asyncpg.Pool | None = None
+
+# =========================
+# Клавиатуры (статичные, создаются один раз)
+# =========================
+ADMIN_KB = types.ReplyKeyboardMarkup(keyboard=[
+    [types.KeyboardButton(text="💰 ДАЛ ДЕНЕГ")],
+    [types.KeyboardButton(text="📊 Статистика"), types.KeyboardButton(text="💸 Должен")],
+], resize_keyboard=True)
+HR_KB = types.ReplyKeyboardMarkup(keyboard=[
+    [types.KeyboardButton(text="💵 Потратил"), types.KeyboardButton(text="📥 Пришли")],
+    [types.KeyboardButton(text="💰 Баланс")]
+], resize_keyboard=True)
+IT_KB = types.ReplyKeyboardMarkup(keyboard=[
+    [types.KeyboardButton(text="💵 Потратил"), types.KeyboardButton(text="📥 Пришли")],
+    [types.KeyboardButton(text="💰 Баланс")]
+], resize_keyboard=True)
+IT_CATEGORY_KB = types.ReplyKeyboardMarkup(
+    keyboard=[[types.KeyboardButton(text=c)] for c in IT_CATEGORIES],
+    resize_keyboard=True
+)
+# Приветствие и клавиатура панели для каждой роли
+PANEL_FOR_ROLE = {
+    "admin": ("🔑 <b>Админ-панель</b>", ADMIN_KB),
+    "hr": ("👩‍💼 HR панель", HR_KB),
+    "it": ("💻 IT панель", IT_KB),
+}
 
 # =========================
 # FSM: Пошаговое внесение расхода
@@ -51,102 +115,360 @@ class SpendForm(StatesGroup):
     waiting_for_comment = State()
     waiting_for_photo = State()
 
+# =========================
+# FSM: Пополнение баланса
+# =========================
+class TopUpForm(StatesGroup):
+    waiting_for_amount = State()
+
 # =========================
 # Вспомогательные функции
 # =========================
+# Ссылки на фоновые задачи, чтобы их не собрал GC до завершения
+_background_tasks: set[asyncio.Task] = set()
+
+def _on_background_done(task: asyncio.Task):
+    _background_tasks.discard(task)
+    if not task.cancelled() and task.exception() is not None:
+        logger.error("Ошибка в фоновой задаче", exc_info=task.exception())
+
+def run_in_background(coro) -> asyncio.Task:
+    task = asyncio.create_task(coro)
+    _background_tasks.add(task)
+    task.add_done_callback(_on_background_done)
+    return task
+
+# Сколько при остановке ждать обработки апдейтов, принятых вебхуком
+BACKGROUND_DRAIN_TIMEOUT = 20
+
+async def _drain_background_tasks(exclude: asyncio.Task | None = None):
+    pending = [t for t in _background_tasks if t is not exclude]
+    if not pending:
+        return
+    _, still_running = await asyncio.wait(pending, timeout=BACKGROUND_DRAIN_TIMEOUT)
+    if still_running:
+        logger.error("Не завершено фоновых задач при остановке: %d", len(still_running))
+
+# Уведомления админу идут через очередь с одним отправителем: всплеск расходов
+# сглаживается, а пользователь получает ответ сразу. Очередь и пауза свои в каждом
+# воркере uvicorn, так что при WEB_CONCURRENCY > 1 общий темп выше 30 сообщений/с;
+# от 429 при этом защищает повтор после TelegramRetryAfter.
+ADMIN_NOTIFY_INTERVAL = 1 / 30
+# Сколько при остановке ждать отправки уже поставленных в очередь уведомлений
+ADMIN_OUTBOX_DRAIN_TIMEOUT = 10
+_admin_outbox: asyncio.Queue[tuple[type[SendMessage | SendPhoto], dict]] = asyncio.Queue()
+_admin_notifier_task: asyncio.Task | None = None
+
+async def save_admin_chat_id(chat_id: int):
+    await redis.set("admin_chat_id", chat_id)
+
+async def get_admin_chat_id() -> int | None:
+    if ADMIN_CHAT_ID:
+        return int(ADMIN_CHAT_ID)
+    chat_id = await redis.get("admin_chat_id")
+    return int(chat_id) if chat_id is not None else None
+
+def notify_admin(method_cls: type[SendMessage | SendPhoto], **kwargs):
+    # chat_id подставляется при отправке
+    _admin_outbox.put_nowait((method_cls, kwargs))
+
+def expense_notice(username: str, amount: float, comment: str, category: str | None) -> str:
+    return (f"💵 <b>Расход от {html.escape(username)}</b>\n💰 {amount} грн\n"
+            f"📝 {html.escape(comment or '')}\n📂 {category or 'HR'}")
+
+async def _admin_notifier():
+    while True:
+        method_cls, kwargs = await _admin_outbox.get()
+        try:
+            chat_id = await get_admin_chat_id()
+            if chat_id is None:
+                logger.error("Chat id админа неизвестен: задайте ADMIN_CHAT_ID или отправьте /start от админа")
+                continue
+            method = method_cls(chat_id=chat_id, **kwargs)
+            while True:
+                try:
+                    await bot(method)
+                    break
+                except TelegramRetryAfter as e:
+                    await asyncio.sleep(e.retry_after)
+        except Exception:
+            logger.exception("Не удалось отправить уведомление админу")
+        finally:
+            _admin_outbox.task_done()
+        await asyncio.sleep(ADMIN_NOTIFY_INTERVAL)
+
+async def _drain_admin_outbox():
+    try:
+        await asyncio.wait_for(_admin_outbox.join(), ADMIN_OUTBOX_DRAIN_TIMEOUT)
+    except asyncio.TimeoutError:
+        logger.error("Не отправлено уведомлений админу при остановке: %d", _admin_outbox.qsize())
+
+def _user_key(message: Message) -> str:
+    # Пользователи без username идентифицируются по id, а не как "@None"
+    user = message.from_user
+    return f"@{user.username}" if user.username else f"id{user.id}"
+
+# Сумма: целое или дробное положительное число, разделитель точка или запятая
+_AMOUNT_RE = re.compile(r"\d+(?:[.,]\d+)?")
+
+def parse_amount(text: str | None) -> float | None:
+    m = _AMOUNT_RE.fullmatch((text or "").strip())
+    if not m:
+        return None
+    amount = float(m.group(0).replace(",", "."))
+    # "0" и "0,00" проходят по регулярке, но нулевая сумма не допускается
+    return amount if amount > 0 else None
+
+# Отформатированное время кэшируется и пересчитывается только при смене секунды
+_ts_cache = [0, ""]
+
 def now_str() -> str:
-    return datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S")
+    s = int(time.time())
+    if s != _ts_cache[0]:
+        _ts_cache[0] = s
+        _ts_cache[1] = datetime.fromtimestamp(s, timezone.utc).isoformat(sep=" ", timespec="seconds")
+    return _ts_cache[1]
+
+# =========================
+# SQL горячего пути: asyncpg подготавливает и кэширует запросы на каждом соединении
+# =========================
+UPSERT_USER_SQL = (
+    "INSERT INTO users (username, role, balance) VALUES ($1, $2, 0) "
+    "ON CONFLICT (username) DO NOTHING"
+)
+SELECT_BALANCE_SQL = "SELECT balance FROM users WHERE username = $1"
+# Атомарное изменение баланса одним запросом, без гонки read-modify-write
+ADJUST_BALANCE_SQL = "UPDATE users SET balance = balance + $1 WHERE username = $2 RETURNING balance"
+# Списание и запись расхода одним запросом: оба изменения применяются атомарно.
+# Если пользователя нет в users, расход не записывается и запрос не возвращает строк.
+RECORD_EXPENSE_SQL = (
+    "WITH b AS ("
+    "UPDATE users SET balance = balance - $1 WHERE username = $2 RETURNING balance"
+    ") "
+    "INSERT INTO expenses (username, role, category, amount, comment, photo_id) "
+    "SELECT $2, $3, $4, $1, $5, $6 FROM b "
+    "RETURNING (SELECT balance FROM b)"
+)
+
+# Админская статистика: одним запросом и только нужные колонки
+USERS_BALANCES_SQL = "SELECT username, role, balance FROM users ORDER BY role, username"
+# Общая сумма расходов и последние расходы: листинг читается с начала индекса по created_at
+EXPENSES_TOTAL_SQL = "SELECT sum(amount) FROM expenses"
+RECENT_EXPENSES_LIMIT = 20
+RECENT_EXPENSES_SQL = (
+    "SELECT username, created_at, amount, category "
+    "FROM expenses ORDER BY created_at DESC LIMIT $1"
+)
+
+async def _fetchval(sql: str, *args):
+    async with pool.acquire() as conn:
+        return await conn.fetchval(sql, *args)
+
+# Пользователи, уже заведённые в БД этим процессом: повторный /start не ходит в базу
+_known_users: TTLCache = TTLCache(maxsize=1024, ttl=300)
 
 async def ensure_user_in_db(username: str, role: str):
-    existing = supabase.table("users").select("*").eq("username", username).execute()
-    if not existing.data:
-        supabase.table("users").insert({
-            "username": username,
-            "role": role,
-            "balance": 0,
-            "created_at": now_str()
-        }).execute()
+    if username in _known_users:
+        return
+    await _fetchval(UPSERT_USER_SQL, username, role)
+    _known_users[username] = role
+
+def forget_user(username: str):
+    # Строки пользователя в БД нет: следующий /start должен снова выполнить upsert
+    _known_users.pop(username, None)
+
+# Кэш баланса в Redis: заполняется при чтении и сбрасывается при каждом изменении.
+# Каждое изменение увеличивает версию bal_ver:{username}; чтение запоминает версию
+# до запроса в БД и кладёт значение в кэш, только если версия не изменилась,
+# иначе промах мог бы вернуть в кэш баланс, прочитанный до параллельной записи.
+BALANCE_CACHE_TTL = 300
+
+# KEYS[1] = bal:{username}, KEYS[2] = bal_ver:{username}; ARGV = версия, баланс, TTL
+_CACHE_BALANCE_LUA = redis.register_script(
+    "if (redis.call('GET', KEYS[2]) or '0') == ARGV[1] then "
+    "return redis.call('SET', KEYS[1], ARGV[2], 'EX', ARGV[3]) end "
+    "return nil"
+)
+
+async def cache_balance(username: str, balance: float, version: bytes | None):
+    await _CACHE_BALANCE_LUA(
+        keys=[f"bal:{username}", f"bal_ver:{username}"],
+        args=[version or b"0", balance, BALANCE_CACHE_TTL],
+    )
+
+async def invalidate_balance(username: str):
+    async with redis.pipeline(transaction=True) as pipe:
+        pipe.incr(f"bal_ver:{username}")
+        pipe.delete(f"bal:{username}")
+        await pipe.execute()
 
 async def get_balance(username: str) -> float:
-    data = supabase.table("users").select("balance").eq("username", username).execute()
-    return data.data[0]["balance"] if data.data else 0
+    cached = await redis.get(f"bal:{username}")
+    if cached is not None:
+        return float(cached)
+    version = await redis.get(f"bal_ver:{username}")
+    balance = await _fetchval(SELECT_BALANCE_SQL, username)
+    balance = float(balance or 0)
+    await cache_balance(username, balance, version)
+    return balance
+
+async def adjust_balance(username: str, delta: float) -> float | None:
+    # None: пользователя нет в users, баланс не изменён
+    balance = await _fetchval(ADJUST_BALANCE_SQL, delta, username)
+    if balance is None:
+        forget_user(username)
+        return None
+    await invalidate_balance(username)
+    return float(balance)
+
+async def record_expense(username: str, role: str, category: str | None, amount: float,
+                         comment: str, photo_id: str | None) -> float | None:
+    balance = await _fetchval(RECORD_EXPENSE_SQL, amount, username, role, category, comment, photo_id)
+    if balance is None:
+        forget_user(username)
+        return None
+    await invalidate_balance(username)
+    return float(balance)
+
+async def get_users_balances() -> list[asyncpg.Record]:
+    async with pool.acquire() as conn:
+        return await conn.fetch(USERS_BALANCES_SQL)
+
+async def get_expenses_total() -> float:
+    async with pool.acquire() as conn:
+        return float(await conn.fetchval(EXPENSES_TOTAL_SQL) or 0)
+
+async def get_recent_expenses(limit: int = RECENT_EXPENSES_LIMIT) -> list[asyncpg.Record]:
+    async with pool.acquire() as conn:
+        return await conn.fetch(RECENT_EXPENSES_SQL, limit)
 
-async def update_balance(username: str, new_balance: float):
-    supabase.table("users").update({"balance": new_balance}).eq("username", username).execute()
+# =========================
+# Пул соединений с Postgres
+# =========================
+async def init_schema():
+    # Схема применяется до создания пула: ON CONFLICT (username) требует уникального индекса
+    with open(INIT_SQL_PATH, encoding="utf-8") as f:
+        init_sql = f.read()
+    conn = await asyncpg.connect(DATABASE_URL, statement_cache_size=0)
+    try:
+        async with conn.transaction():
+            await conn.execute(init_sql)
+    finally:
+        await conn.close()
+
+async def on_startup():
+    global pool, _admin_notifier_task
+    if _admin_notifier_task is None:
+        _admin_notifier_task = run_in_background(_admin_notifier())
+    if pool is None:
+        await init_schema()
+        # Соединения, простаивающие дольше 30 минут, закрываются и переоткрываются пулом
+        pool = await asyncpg.create_pool(
+            DATABASE_URL,
+            min_size=2,
+            max_size=10,
+            max_inactive_connection_lifetime=1800,
+            # Пулер в transaction mode не сохраняет именованные подготовленные запросы между транзакциями
+            statement_cache_size=0 if DB_TRANSACTION_POOLER else 100
+        )
+
+async def on_shutdown():
+    global pool, _admin_notifier_task
+    # Сначала даём дообработаться принятым апдейтам: им ещё нужны пул, Redis и сессия бота
+    await _drain_background_tasks(exclude=_admin_notifier_task)
+    if _admin_notifier_task is not None:
+        await _drain_admin_outbox()
+        _admin_notifier_task.cancel()
+        _admin_notifier_task = None
+    if pool is not None:
+        await pool.close()
+        pool = None
+    await dp.storage.close()
+    await bot.session.close()
+
+dp.startup.register(on_startup)
+dp.shutdown.register(on_shutdown)
 
 # =========================
 # /start
 # =========================
 @dp.message(CommandStart())
 async def start_handler(message: Message, state: FSMContext):
-    username = f"@{message.from_user.username}" if message.from_user.username else f"id{message.from_user.id}"
+    username = _user_key(message)
     await state.clear()
 
-    if username == ALLOWED_ADMIN:
-        role = "admin"
-        await ensure_user_in_db(username, role)
-        kb = [
-            [types.KeyboardButton(text="💰 ДАЛ ДЕНЕГ")],
-            [types.KeyboardButton(text="📊 Статистика"), types.KeyboardButton(text="💸 Должен")],
-        ]
-        await message.answer("🔑 <b>Админ-панель</b>", reply_markup=types.ReplyKeyboardMarkup(keyboard=kb, resize_keyboard=True))
-    elif username in HR_USERS:
-        role = "hr"
-        await ensure_user_in_db(username, role)
-        kb = [
-            [types.KeyboardButton(text="💵 Потратил"), types.KeyboardButton(text="📥 Пришли")],
-            [types.KeyboardButton(text="💰 Баланс")]
-        ]
-        await message.answer("👩‍💼 HR панель", reply_markup=types.ReplyKeyboardMarkup(keyboard=kb, resize_keyboard=True))
-    elif username in IT_USERS:
-        role = "it"
-        await ensure_user_in_db(username, role)
-        kb = [
-            [types.KeyboardButton(text="💵 Потратил"), types.KeyboardButton(text="📥 Пришли")],
-            [types.KeyboardButton(text="💰 Баланс")]
-        ]
-        await message.answer("💻 IT панель", reply_markup=types.ReplyKeyboardMarkup(keyboard=kb, resize_keyboard=True))
-    else:
+    role = "admin" if username == ALLOWED_ADMIN else USER_ROLES.get(username.lower())
+    panel = PANEL_FOR_ROLE.get(role)
+    if panel is None:
         await message.answer("❌ У вас нет доступа к этому боту.")
+        return
+    text, kb = panel
+    tasks = [ensure_user_in_db(username, role), message.answer(text, reply_markup=kb)]
+    if role == "admin":
+        # Запоминаем чат админа для уведомлений о расходах
+        tasks.append(save_admin_chat_id(message.chat.id))
+    await asyncio.gather(*tasks)
 
 # =========================
 # Баланс
 # =========================
 @dp.message(F.text == "💰 Баланс")
 async def balance_handler(message: Message):
-    username = f"@{message.from_user.username}"
+    username = _user_key(message)
     balance = await get_balance(username)
     await message.answer(f"💰 Текущий баланс: <b>{balance} грн</b>")
 
+# =========================
+# Админ: статистика
+# =========================
+# Проверка админа в самом фильтре: сообщения остальных уходят дальше, в FSM-хендлеры
+@dp.message(F.text == "📊 Статистика", F.from_user.username == ALLOWED_ADMIN[1:])
+async def admin_stats_handler(message: Message):
+    users, total, expenses = await asyncio.gather(
+        get_users_balances(), get_expenses_total(), get_recent_expenses()
+    )
+    balance_lines = [f"{r['username']} ({r['role']}): {float(r['balance'] or 0)} грн" for r in users]
+    expense_lines = [
+        f"{str(r['created_at'])[:16]} | {r['username']} | {float(r['amount'])} грн | {r['category'] or 'HR'}"
+        for r in expenses
+    ]
+    await message.answer(
+        "📊 <b>Балансы пользователей</b>\n" + ("\n".join(balance_lines) or "Нет пользователей.")
+        + f"\n\n💵 <b>Всего расходов:</b> {total} грн"
+        + f"\n<b>Последние {RECENT_EXPENSES_LIMIT}:</b>\n" + ("\n".join(expense_lines) or "Нет расходов.")
+    )
+
 # =========================
 # Пополнение
 # =========================
 @dp.message(F.text == "📥 Пришли")
-async def plus_balance(message: Message):
-    username = f"@{message.from_user.username}"
+async def plus_balance(message: Message, state: FSMContext):
     await message.answer("Введите сумму для пополнения:")
+    await state.set_state(TopUpForm.waiting_for_amount)
 
-    @dp.message()
-    async def add_sum(msg: Message):
-        try:
-            amount = float(msg.text)
-            old_balance = await get_balance(username)
-            new_balance = old_balance + amount
-            await update_balance(username, new_balance)
-            await msg.answer(f"✅ Баланс пополнен на {amount} грн.\n💰 Новый баланс: {new_balance} грн.")
-        except ValueError:
-            await msg.answer("❌ Введите корректное число.")
-        dp.message.handlers.pop()  # очистка
+@dp.message(TopUpForm.waiting_for_amount)
+async def process_topup_amount(message: Message, state: FSMContext):
+    amount = parse_amount(message.text)
+    if amount is None:
+        await message.answer("❌ Введите корректное число.")
+        return
+    new_balance = await adjust_balance(_user_key(message), amount)
+    if new_balance is None:
+        await asyncio.gather(message.answer(UNKNOWN_USER_TEXT), state.clear())
+        return
+    await asyncio.gather(
+        message.answer(f"✅ Баланс пополнен на {amount} грн.\n💰 Новый баланс: {new_balance} грн."),
+        state.clear()
+    )
 
 # =========================
 # FSM: Потратил
 # =========================
 @dp.message(F.text == "💵 Потратил")
 async def spent_start(message: Message, state: FSMContext):
-    username = f"@{message.from_user.username}"
-    if username in IT_USERS:
-        kb = [[types.KeyboardButton(text=c)] for c in IT_CATEGORIES]
-        await message.answer("Выберите категорию расхода:", reply_markup=types.ReplyKeyboardMarkup(keyboard=kb, resize_keyboard=True))
+    username = _user_key(message)
+    if username.lower() in IT_USERS:
+        await message.answer("Выберите категорию расхода:", reply_markup=IT_CATEGORY_KB)
         await state.set_state(SpendForm.waiting_for_category)
     else:
         await message.answer("Введите сумму, которую вы потратили:")
@@ -154,7 +476,7 @@ async def spent_start(message: Message, state: FSMContext):
 
 @dp.message(SpendForm.waiting_for_category)
 async def process_category(message: Message, state: FSMContext):
-    if message.text not in IT_CATEGORIES:
+    if message.text not in IT_CATEGORIES_SET:
         await message.answer("❌ Выберите категорию из кнопок.")
         return
     await state.update_data(category=message.text)
@@ -163,13 +485,13 @@ async def process_category(message: Message, state: FSMContext):
 
 @dp.message(SpendForm.waiting_for_amount)
 async def process_amount(message: Message, state: FSMContext):
-    try:
-        amount = float(message.text)
-        await state.update_data(amount=amount)
-        await message.answer("Опишите, на что были потрачены деньги:")
-        await state.set_state(SpendForm.waiting_for_comment)
-    except ValueError:
+    amount = parse_amount(message.text)
+    if amount is None:
         await message.answer("❌ Введите корректное число.")
+        return
+    await state.update_data(amount=amount)
+    await message.answer("Опишите, на что были потрачены деньги:")
+    await state.set_state(SpendForm.waiting_for_comment)
 
 @dp.message(SpendForm.waiting_for_comment)
 async def process_comment(message: Message, state: FSMContext):
@@ -181,65 +503,85 @@ async def process_comment(message: Message, state: FSMContext):
 async def process_photo(message: Message, state: FSMContext):
     file_id = message.photo[-1].file_id
     data = await state.get_data()
-    username = f"@{message.from_user.username}"
+    username = _user_key(message)
     amount = data['amount']
     comment = data['comment']
     category = data.get("category", None)
 
-    # Списание с баланса
-    old_balance = await get_balance(username)
-    new_balance = old_balance - amount
-    await update_balance(username, new_balance)
-
-    supabase.table("expenses").insert({
-        "username": username,
-        "role": "it" if username in IT_USERS else "hr",
-        "category": category,
-        "amount": amount,
-        "comment": comment,
-        "photo_id": file_id,
-        "created_at": now_str()
-    }).execute()
-
-    await message.answer(f"✅ Расход {amount} грн добавлен и списан с баланса.\n💰 Новый баланс: {new_balance} грн.")
-    await bot.send_photo(chat_id=ALLOWED_ADMIN, photo=file_id,
-                         caption=f"💵 <b>Расход от {username}</b>\n💰 {amount} грн\n📝 {comment}\n📂 {category or 'HR'}")
-    await state.clear()
+    # Списание с баланса и запись расхода
+    role = USER_ROLES.get(username.lower(), "hr")
+    new_balance = await record_expense(username, role, category, amount, comment, file_id)
+    if new_balance is None:
+        await asyncio.gather(message.answer(UNKNOWN_USER_TEXT), state.clear())
+        return
+
+    notify_admin(SendPhoto, photo=file_id, caption=expense_notice(username, amount, comment, category))
+    await asyncio.gather(
+        message.answer(f"✅ Расход {amount} грн добавлен и списан с баланса.\n💰 Новый баланс: {new_balance} грн."),
+        state.clear()
+    )
 
 @dp.message(SpendForm.waiting_for_photo)
 async def process_no_photo(message: Message, state: FSMContext):
     if message.text.lower() == "нет":
         data = await state.get_data()
-        username = f"@{message.from_user.username}"
+        username = _user_key(message)
         amount = data['amount']
         comment = data['comment']
         category = data.get("category", None)
 
-        old_balance = await get_balance(username)
-        new_balance = old_balance - amount
-        await update_balance(username, new_balance)
-
-        supabase.table("expenses").insert({
-            "username": username,
-            "role": "it" if username in IT_USERS else "hr",
-            "category": category,
-            "amount": amount,
-            "comment": comment,
-            "photo_id": None,
-            "created_at": now_str()
-        }).execute()
-
-        await message.answer(f"✅ Расход {amount} грн добавлен без фото и списан с баланса.\n💰 Новый баланс: {new_balance} грн.")
-        await bot.send_message(chat_id=ALLOWED_ADMIN,
-                               text=f"💵 <b>Расход от {username}</b>\n💰 {amount} грн\n📝 {comment}\n📂 {category or 'HR'}")
-        await state.clear()
+        role = USER_ROLES.get(username.lower(), "hr")
+        new_balance = await record_expense(username, role, category, amount, comment, None)
+        if new_balance is None:
+            await asyncio.gather(message.answer(UNKNOWN_USER_TEXT), state.clear())
+            return
+
+        notify_admin(SendMessage, text=expense_notice(username, amount, comment, category))
+        await asyncio.gather(
+            message.answer(f"✅ Расход {amount} грн добавлен без фото и списан с баланса.\n💰 Новый баланс: {new_balance} грн."),
+            state.clear()
+        )
     else:
         await message.answer("❌ Отправьте фото или напишите 'нет'.")
 
 # =========================
 # FastAPI для Render
 # =========================
-app = FastAPI()
+async def setup_webhook():
+    # Все воркеры стартуют одновременно, а setWebhook ограничен по частоте:
+    # вызываем его, только если вебхук ещё не настроен, и переживаем RetryAfter.
+    # Секрет getWebhookInfo не возвращает, поэтому храним в Redis его хэш:
+    # после смены WEBHOOK_SECRET вебхук перенастраивается, а не отвечает 403
+    allowed_updates = dp.resolve_used_update_types()
+    secret_hash = hashlib.sha256((WEBHOOK_SECRET or "").encode()).hexdigest()
+    while True:
+        try:
+            info = await bot.get_webhook_info()
+            stored_hash = await redis.get("webhook_secret_hash")
+            if (info.url == WEBHOOK_URL
+                    and sorted(info.allowed_updates or []) == sorted(allowed_updates)
+                    and stored_hash is not None and stored_hash.decode() == secret_hash):
+                return
+            await bot.set_webhook(
+                WEBHOOK_URL,
+                secret_token=WEBHOOK_SECRET,
+                allowed_updates=allowed_updates
+            )
+            await redis.set("webhook_secret_hash", secret_hash)
+            return
+        except TelegramRetryAfter as e:
+            await asyncio.sleep(e.retry_after)
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    await on_startup()
+    if WEBHOOK_URL:
+        # Вебхук не удаляется при остановке: остальные воркеры продолжают принимать апдейты
+        await setup_webhook()
+    yield
+    await on_shutdown()
+
+app = FastAPI(default_response_class=ORJSONResponse, lifespan=lifespan)
 
 @app.get("/health")
 async def health():
@@ -247,8 +589,13 @@ async def health():
 
 @app.post("/webhook")
 async def webhook(request: Request):
-    update = await request.json()
-    await dp.feed_webhook_update(bot, update)
+    if WEBHOOK_SECRET and not secrets.compare_digest(
+        request.headers.get("X-Telegram-Bot-Api-Secret-Token", "").encode(), WEBHOOK_SECRET.encode()
+    ):
+        raise HTTPException(status_code=403)
+    update = orjson.loads(await request.body())
+    # Отвечаем Telegram сразу, апдейт обрабатывается в фоне
+    run_in_background(dp.feed_webhook_update(bot, update))
     return {"ok": True}
 
 # =========================
@@ -256,11 +603,21 @@ async def webhook(request: Request):
 # =========================
 async def main():
     print("🚀 Бот запущен и готов к работе...")
-    await dp.start_polling(bot)
+    # Запрашиваем только те типы апдейтов, на которые есть хендлеры
+    await dp.start_polling(bot, allowed_updates=dp.resolve_used_update_types(), polling_timeout=30)
 
 if __name__ == "__main__":
     if os.getenv("RENDER", "false").lower() == "true":
         import uvicorn
-        uvicorn.run("bot:app", host="0.0.0.0", port=8080)
+        uvicorn.run(
+            "bot:app",
+            host="0.0.0.0",
+            port=8080,
+            loop="uvloop",
+            http="httptools",
+            workers=int(os.getenv("WEB_CONCURRENCY", "2")),
+            access_log=False
+        )
     else:
-        asyncio.run(main())
+        import uvloop
+        uvloop.run(main())
@@ -0,0 +1,32 @@
+-- Идемпотентная инициализация схемы, выполняется при старте бота.
+-- Блокировка не даёт нескольким воркерам выполнять DDL одновременно.
+SELECT pg_advisory_xact_lock(hashtext('bot_init'));
+
+-- Уникальный индекс по username: быстрый поиск пользователя
+-- и цель для INSERT ... ON CONFLICT (username).
+-- Предусловие: в users нет повторяющихся username (старый select-then-insert мог их создать).
+-- Дубликаты не сливаются автоматически, чтобы не потерять балансы: при их наличии
+-- старт останавливается с понятной ошибкой, строки нужно объединить вручную.
+DO $$
+DECLARE
+    dups text;
+BEGIN
+    IF to_regclass('users_username_key') IS NULL THEN
+        SELECT string_agg(username, ', ') INTO dups
+        FROM (SELECT username FROM users GROUP BY username HAVING count(*) > 1) d;
+        IF dups IS NOT NULL THEN
+            RAISE EXCEPTION 'users содержит повторяющиеся username (%), объедините строки перед запуском бота', dups;
+        END IF;
+    END IF;
+END $$;
+CREATE UNIQUE INDEX IF NOT EXISTS users_username_key ON users (username);
+
+-- Расходы пользователя в хронологическом порядке
+CREATE INDEX IF NOT EXISTS expenses_user_time ON expenses (username, created_at DESC);
+
+-- Последние расходы для админской статистики (ORDER BY created_at DESC LIMIT)
+CREATE INDEX IF NOT EXISTS expenses_created_at_idx ON expenses (created_at DESC);
+
+-- Время создания проставляет сама база, бот его не передаёт
+ALTER TABLE users ALTER COLUMN created_at SET DEFAULT now();
+ALTER TABLE expenses ALTER COLUMN created_at SET DEFAULT now();